@@ -1,6 +1,7 @@
 # R2R-EnvDrop, 2019, haotan@cs.unc.edu
 # Modified in Recurrent VLN-BERT, 2020, by Yicong.Hong@anu.edu.au
 
+import inspect
 import json
 import os
 import sys
@@ -22,8 +23,52 @@ import model_PREVALENT
 import param
 from param import args
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 from shared_optim import ensure_shared_grads
 
+# clip_grad_norm_'s fused multi-tensor path only exists on torch >= 2.0
+_CLIP_KWARGS = {'foreach': True} \
+    if 'foreach' in inspect.signature(torch.nn.utils.clip_grad_norm_).parameters else {}
+
+
+@njit(cache=True)
+def _compute_lengths(seq_tensor, pad_id):
+    ''' First padding position per row, fused equality+argmax with early exit. '''
+    lengths = np.empty(seq_tensor.shape[0], dtype=np.int64)
+    for i in range(seq_tensor.shape[0]):
+        lengths[i] = seq_tensor.shape[1]
+        for j in range(seq_tensor.shape[1]):
+            if seq_tensor[i, j] == pad_id:
+                lengths[i] = j
+                break
+        if lengths[i] == 0:   # all-padding rows keep the full length, as before
+            lengths[i] = seq_tensor.shape[1]
+    return lengths
+
+
+def _angle_feature_batch(headings, elevations):
+    ''' Vectorized utils.angle_feature over a batch of observations. '''
+    base = np.stack([np.sin(headings), np.cos(headings),
+                     np.sin(elevations), np.cos(elevations)], -1).astype(np.float32)
+    return np.tile(base, (1, args.angle_feat_size // 4))
+
+
+@njit(cache=True)
+def _teacher_action_search(cand_ids, cand_counts, target_ids, ended, ignoreid):
+    ''' Linear scan for the teacher viewpoint over packed candidate ids. '''
+    a = np.empty(cand_ids.shape[0], dtype=np.int64)
+    for i in range(cand_ids.shape[0]):
+        if ended[i]:                    # Just ignore this index
+            a[i] = ignoreid
+            continue
+        a[i] = cand_counts[i]           # Stop here
+        for k in range(cand_counts[i]):
+            if cand_ids[i, k] == target_ids[i]:     # Next view point
+                a[i] = k
+                break
+    return a
+
 
 class BaseAgent(object):
     ''' Base class for an R2R agent to generate and save trajectories. '''
@@ -114,31 +159,56 @@ class Seq2SeqAgent(BaseAgent):
         self.losses = []
         self.criterion = nn.CrossEntropyLoss(ignore_index=args.ignoreid, size_average=False)
         self.ndtw_criterion = utils.ndtw_initialize()
-        self.disloss = nn.KLDivLoss()
+
+        # BF16 halves the bandwidth of the BERT forward passes on Ampere+;
+        # fall back to fp16 (with the caller's GradScaler) on older cards
+        self._amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+        # Persistent buffers, allocated once and reused across rollouts to avoid
+        # a fresh host allocation + H2D copy (and allocator churn) every call
+        self._vis_taj_buf = torch.zeros(self.batch_size, self.episode_len,
+                                        self.feature_size + args.angle_feat_size, device='cuda')
+        self._cand_host = None      # pinned host staging buffer for candidate features
+        self._seq_host = None       # pinned host staging buffer for instruction encodings
+        self._input_a_host = torch.zeros(self.batch_size, args.angle_feat_size).pin_memory()
+        self._arange_cu = torch.arange(128, device='cuda')   # shared by the length masks
+        self._vp_ids = {}   # viewpoint string -> packed integer id for the njit search
+        self._obs_buf = np.empty(self.batch_size, dtype=object)
+        self._perm_obs_buf = np.empty(self.batch_size, dtype=object)
+        self._sim_pool = ThreadPoolExecutor(max_workers=self.batch_size)   # one worker per sim
 
         # Logs
         sys.stdout.flush()
         self.logs = defaultdict(list)
 
     def _sort_batch(self, obs):
-        seq_tensor = np.array([ob['instr_encoding'] for ob in obs])
-        seq_lengths = np.argmax(seq_tensor == padding_idx, axis=1)
-        seq_lengths[seq_lengths == 0] = seq_tensor.shape[1]
-
-        seq_tensor = torch.from_numpy(seq_tensor)
-        seq_lengths = torch.from_numpy(seq_lengths)
+        enc_len = len(obs[0]['instr_encoding'])
+        if self._seq_host is None or self._seq_host.size(1) != enc_len:
+            self._seq_host = torch.zeros(self.batch_size, enc_len, dtype=torch.int64).pin_memory()
+        seq_host = self._seq_host[:len(obs)]
+        seq_np = seq_host.numpy()
+        for i, ob in enumerate(obs):
+            seq_np[i] = ob['instr_encoding']
+        seq_lengths = torch.from_numpy(_compute_lengths(seq_np, padding_idx))
 
         # Sort sequences by lengths
         seq_lengths, perm_idx = seq_lengths.sort(0, True)  # True -> descending
-        sorted_tensor = seq_tensor[perm_idx]
+        seq_cu = seq_host.to('cuda', non_blocking=True)    # one coalesced upload from pinned memory
+        sorted_tensor = seq_cu[perm_idx.cuda()]
         mask = (sorted_tensor != padding_idx)
 
         token_type_ids = torch.zeros_like(mask)
 
-        return Variable(sorted_tensor, requires_grad=False).long().cuda(), \
-               mask.long().cuda(), token_type_ids.long().cuda(), \
+        return Variable(sorted_tensor, requires_grad=False).long(), \
+               mask.long(), token_type_ids.long(), \
                list(seq_lengths), list(perm_idx)
 
+    def _arange(self, n):
+        ''' Cached cuda arange, grown on demand (avoids a per-step allocation). '''
+        if n > self._arange_cu.size(0):
+            self._arange_cu = torch.arange(n, device='cuda')
+        return self._arange_cu[:n]
+
     def _feature_variable(self, obs):
         ''' Extract precomputed features into variable. '''
         features = np.empty((len(obs), args.views, self.feature_size + args.angle_feat_size), dtype=np.float32)
@@ -148,31 +218,63 @@ class Seq2SeqAgent(BaseAgent):
 
     def _candidate_variable(self, obs, t, vis_taj, input_a_t):
         candidate_leng = [len(ob['candidate']) + 1 + t for ob in obs]  # +1 is for the end
-        candidate_feat = np.zeros((len(obs), max(candidate_leng), self.feature_size + args.angle_feat_size), dtype=np.float32)
-        candidate_feat = torch.from_numpy(candidate_feat).cuda()
+        # Fresh per-step tensor: the caching allocator reuses the freed block
+        # without cudaMalloc churn, and earlier steps of the same rollout keep
+        # their saved activations intact (a shared buffer would be mutated
+        # under the live autograd graph)
+        candidate_feat = torch.zeros(len(obs), max(candidate_leng),
+                                     self.feature_size + args.angle_feat_size, device='cuda')
 
         if t > 0:
             candidate_feat[:, :t-1, :] = vis_taj[:, :t-1, :]
             candidate_feat[:, t-1, :self.feature_size] = vis_taj[:, t-1, :self.feature_size]
             candidate_feat[:, t-1, -args.angle_feat_size:] = input_a_t
 
-        for i, ob in enumerate(obs):
-            for j, cc in enumerate(ob['candidate']):
-                cc_feature = torch.from_numpy(cc['feature']).cuda()
-                candidate_feat[i, j+t, :] = cc_feature
+        # Pack all candidate features into one pinned host buffer and issue a
+        # single H2D copy instead of one tiny transfer per candidate
+        max_cand = max(candidate_leng) - 1 - t
+        if max_cand > 0:
+            if self._cand_host is None or self._cand_host.size(1) < max_cand:
+                self._cand_host = torch.zeros(self.batch_size, max_cand,
+                                              self.feature_size + args.angle_feat_size).pin_memory()
+            cand_host = self._cand_host[:len(obs), :max_cand]
+            cand_host_np = cand_host.numpy()
+            for i, ob in enumerate(obs):
+                if not ob['candidate']:
+                    continue
+                # Stacked (K, D) candidate features; provided by the env when it
+                # precomputes them, otherwise stacked once and cached on the ob
+                feats = ob.get('candidate_feats')
+                if feats is None:
+                    feats = np.ascontiguousarray(np.stack([cc['feature'] for cc in ob['candidate']]))
+                    ob['candidate_feats'] = feats
+                cand_host_np[i, :feats.shape[0]] = feats
+            cand_cu = cand_host.to('cuda', non_blocking=True)
+            counts = torch.tensor([len(ob['candidate']) for ob in obs], device='cuda')
+            scatter_mask = self._arange(max_cand).unsqueeze(0) < counts.unsqueeze(1)
+            candidate_feat[:, t:t+max_cand, :][scatter_mask] = cand_cu[scatter_mask]
 
         return candidate_feat, candidate_leng
 
     def get_input_feat(self, obs, t, vis_taj):
-        input_a_t = np.zeros((len(obs), args.angle_feat_size), np.float32)
-        for i, ob in enumerate(obs):
-            input_a_t[i] = utils.angle_feature(ob['heading'], ob['elevation'])
-        input_a_t = torch.from_numpy(input_a_t).cuda()
+        input_a_host = self._input_a_host[:len(obs)]
+        headings = np.fromiter((ob['heading'] for ob in obs), np.float64, len(obs))
+        elevations = np.fromiter((ob['elevation'] for ob in obs), np.float64, len(obs))
+        input_a_host.numpy()[:] = _angle_feature_batch(headings, elevations)
+        input_a_t = input_a_host.to('cuda', non_blocking=True)   # pinned -> fresh per-step cuda tensor
         # f_t = self._feature_variable(obs)      # Pano image features from obs
         candidate_feat, candidate_leng = self._candidate_variable(obs, t, vis_taj, input_a_t)
 
         return input_a_t, candidate_feat, candidate_leng
 
+    def _vp_id(self, viewpointId):
+        ''' Pack a viewpoint string to a stable integer id. '''
+        idx = self._vp_ids.get(viewpointId)
+        if idx is None:
+            idx = len(self._vp_ids)
+            self._vp_ids[viewpointId] = idx
+        return idx
+
     def _teacher_action(self, obs, ended):
         """
         Extract teacher actions into variable.
@@ -180,20 +282,26 @@ class Seq2SeqAgent(BaseAgent):
         :param ended: Whether the action seq is ended
         :return:
         """
-        a = np.zeros(len(obs), dtype=np.int64)
+        max_cand = max(len(ob['candidate']) for ob in obs)
+        cand_ids = np.full((len(obs), max(max_cand, 1)), -1, dtype=np.int64)
+        cand_counts = np.empty(len(obs), dtype=np.int64)
+        target_ids = np.empty(len(obs), dtype=np.int64)
         for i, ob in enumerate(obs):
-            if ended[i]:                                            # Just ignore this index
-                a[i] = args.ignoreid
-            else:
-                for k, candidate in enumerate(ob['candidate']):
-                    if candidate['viewpointId'] == ob['teacher']:   # Next view point
-                        a[i] = k
-                        break
-                else:   # Stop here
-                    # assert ob['teacher'] == ob['viewpoint']         # The teacher action should be "STAY HERE"
-                    a[i] = len(ob['candidate'])
+            cand_counts[i] = len(ob['candidate'])
+            target_ids[i] = self._vp_id(ob['teacher'])
+            for k, candidate in enumerate(ob['candidate']):
+                cand_ids[i, k] = self._vp_id(candidate['viewpointId'])
+        a = _teacher_action_search(cand_ids, cand_counts, target_ids, ended, args.ignoreid)
         return torch.from_numpy(a).cuda()
 
+    def _step(self, visual_inputs, candidate_mask):
+        ''' One visual-BERT step with the candidate mask folded in. '''
+        h_t, visn_output, logit, dis_loss_c = self.vln_bert(**visual_inputs)
+        # Mask outputs where agent can't move forward
+        # Here the logit is [b, max_candidate]
+        logit = logit.masked_fill(candidate_mask, -float('inf'))
+        return h_t, visn_output, logit, dis_loss_c
+
     def make_equiv_action(self, a_t, perm_obs, perm_idx=None, traj=None):
         """
         Interface between Panoramic view and Egocentric view
@@ -206,33 +314,45 @@ class Seq2SeqAgent(BaseAgent):
             else:                       # Adjust
                 #self.env.env.sims[idx].makeAction(*self.env_actions[name])
                 self.env.env.sims[idx].makeAction([*self.env_actions[name]])
+        def step_one(i, idx, action):
+            select_candidate = perm_obs[i]['candidate'][action]
+            src_point = perm_obs[i]['viewIndex']
+            trg_point = select_candidate['pointId']
+            src_level = (src_point ) // 12  # The point idx started from 0
+            trg_level = (trg_point ) // 12
+            while src_level < trg_level:    # Tune up
+                take_action(i, idx, 'up')
+                src_level += 1
+            while src_level > trg_level:    # Tune down
+                take_action(i, idx, 'down')
+                src_level -= 1
+            #getState() -> getState()[0]
+            # viewIndex advances by 1 per 'right' within a level of 12 views, so
+            # issue the exact turn count instead of polling getState() each turn
+            n_right = (trg_point - self.env.env.sims[idx].getState()[0].viewIndex) % 12
+            for _ in range(n_right):    # Turn right until the target
+                take_action(i, idx, 'right')
+            assert self.env.env.sims[idx].getState()[0].viewIndex == trg_point
+            assert select_candidate['viewpointId'] == \
+                   self.env.env.sims[idx].getState()[0].navigableLocations[select_candidate['idx']].viewpointId
+            take_action(i, idx, select_candidate['idx'])
+
+            state = self.env.env.sims[idx].getState()[0]
+            if traj is not None:
+                traj[i]['path'].append((state.location.viewpointId, state.heading, state.elevation))
+
         if perm_idx is None:
             perm_idx = range(len(perm_obs))
 
+        # Each sim steps only its own state, so the per-env stepping can run
+        # on the pool instead of serializing the C++ calls one env at a time
+        futures = []
         for i, idx in enumerate(perm_idx):
             action = a_t[i]
             if action != -1:            # -1 is the <stop> action
-                select_candidate = perm_obs[i]['candidate'][action]
-                src_point = perm_obs[i]['viewIndex']
-                trg_point = select_candidate['pointId']
-                src_level = (src_point ) // 12  # The point idx started from 0
-                trg_level = (trg_point ) // 12
-                while src_level < trg_level:    # Tune up
-                    take_action(i, idx, 'up')
-                    src_level += 1
-                while src_level > trg_level:    # Tune down
-                    take_action(i, idx, 'down')
-                    src_level -= 1
-                #getState() -> getState()[0]
-                while self.env.env.sims[idx].getState()[0].viewIndex != trg_point:    # Turn right until the target
-                    take_action(i, idx, 'right')
-                assert select_candidate['viewpointId'] == \
-                       self.env.env.sims[idx].getState()[0].navigableLocations[select_candidate['idx']].viewpointId
-                take_action(i, idx, select_candidate['idx'])
-
-                state = self.env.env.sims[idx].getState()[0]
-                if traj is not None:
-                    traj[i]['path'].append((state.location.viewpointId, state.heading, state.elevation))
+                futures.append(self._sim_pool.submit(step_one, i, idx, action))
+        for future in futures:
+            future.result()
 
     def rollout(self, train_ml=None, train_dis_l=None, train_dis_c=None, att_drop_rate=0.5, train_rl=True, reset=True): # 在环境中进行一次探索，然后决定action
         """
@@ -246,17 +366,21 @@ class Seq2SeqAgent(BaseAgent):
             train_rl = False
 
         if reset:  # Reset env 新建重启一个环境
-            obs = np.array(self.env.reset())
+            obs_list = self.env.reset()
         else:
-            obs = np.array(self.env._get_obs())
+            obs_list = self.env._get_obs()
 
-        batch_size = len(obs)  # ob=["instruction":{},"viewpointId":{}, "heading":{},"elevation":{}，“distance”:{},...]表示在此时的位置所获得的信息
-        dis_loss_l = 0.        # obs=[ob1, ob2, ...obn]
+        batch_size = len(obs_list)  # ob=["instruction":{},"viewpointId":{}, "heading":{},"elevation":{}，“distance”:{},...]表示在此时的位置所获得的信息
+        dis_loss_l = 0.             # obs=[ob1, ob2, ...obn]
+        self._obs_buf[:batch_size] = obs_list
+        obs = self._obs_buf[:batch_size]
 
         # Language input
         sentence, language_attention_mask, token_type_ids, \
             seq_lengths, perm_idx = self._sort_batch(obs)   # 根据sentence的长度由长到短进行排序, eg: sentence2,sentence1,sentence0
-        perm_obs = obs[perm_idx] # 对obs根据sentence长度进行排序,eg:perm_obs=[ob2,ob1,ob0]
+        perm_idx_np = np.asarray(perm_idx, dtype=np.int64)
+        perm_obs = self._perm_obs_buf[:batch_size]
+        np.take(obs, perm_idx_np, out=perm_obs) # 对obs根据sentence长度进行排序,eg:perm_obs=[ob2,ob1,ob0]
 
         ''' Language Embedding '''
         language_inputs = {'mode':        'language',
@@ -269,26 +393,29 @@ class Seq2SeqAgent(BaseAgent):
         if args.vlnbert == 'prevalent': #recurrent VLN Bert模型的一种模式
             text_embeds = self.vln_bert(**language_inputs) # 只针对语言进行embedding
 
-        language_attention_mask_drop = torch.rand_like(language_attention_mask.float()) < att_drop_rate #对句子的attention做mask处理，若language_attention_mask对应产生的随机数< att_drop_rate就mask掉.
-        language_attention_mask_drop = language_attention_mask_drop.long()
-        language_attention_mask_drop = language_attention_mask_drop.mul(language_attention_mask) #mul()表示乘法，最终的language_attention_mask_drop综合考虑了padding和attention
-        language_inputs_drop = {'mode':        'language',
-                        'sentence':       sentence,
-                        'attention_mask': language_attention_mask_drop,
-                        'lang_mask':      language_attention_mask_drop,
-                        'token_type_ids': token_type_ids}
-        if args.vlnbert == 'prevalent':
-            text_embeds_drop = self.vln_bert(**language_inputs_drop)
-
-        log_probs1 = F.log_softmax(text_embeds_drop.clone(), 1) #dis_loss_1对应论文第(5)式
-        probs2 = F.softmax(text_embeds.clone().detach(), 1)
-        dis_loss_l += self.disloss(log_probs1, probs2) # disloss用来求KL散度
-
-        log_probs2 = F.log_softmax(text_embeds.clone(), 1)
-        probs1 = F.softmax(text_embeds_drop.clone().detach(), 1)
-        dis_loss_l += self.disloss(log_probs2, probs1)
+        if train_dis_l is not None:     # the dropped language branch only feeds the distillation loss
+            language_attention_mask_drop = (torch.rand_like(language_attention_mask, dtype=torch.float) < att_drop_rate) \
+                                           & language_attention_mask.bool() #对句子的attention做mask处理，若language_attention_mask对应产生的随机数< att_drop_rate就mask掉.
+            language_attention_mask_drop = language_attention_mask_drop.long() #最终的language_attention_mask_drop综合考虑了padding和attention
+            language_inputs_drop = {'mode':        'language',
+                            'sentence':       sentence,
+                            'attention_mask': language_attention_mask_drop,
+                            'lang_mask':      language_attention_mask_drop,
+                            'token_type_ids': token_type_ids}
+            if args.vlnbert == 'prevalent':
+                text_embeds_drop = self.vln_bert(**language_inputs_drop)
+
+            log_probs1 = F.log_softmax(text_embeds_drop, 1) #dis_loss_1对应论文第(5)式
+            log_probs2 = F.log_softmax(text_embeds, 1)
+            # log_target keeps both sides in log space, so no softmax kernel is needed
+            dis_loss_l += F.kl_div(log_probs1, log_probs2.detach(), reduction='batchmean', log_target=True) # 用来求KL散度
+            dis_loss_l += F.kl_div(log_probs2, log_probs1.detach(), reduction='batchmean', log_target=True)
 
         language_features = text_embeds
+        # Project the language K/V once per rollout instead of once per step,
+        # when the model exposes the cache hook
+        lang_kv = self.vln_bert.precompute_lang_kv(text_embeds) \
+            if hasattr(self.vln_bert, 'precompute_lang_kv') else None
         # Record starting point
         traj = [{
             'instr_id': ob['instr_id'],
@@ -314,15 +441,16 @@ class Seq2SeqAgent(BaseAgent):
         masks = []
         entropys = []
         ml_loss = 0.
-        vis_taj = np.zeros((len(obs), self.episode_len, 2176), np.float32)
-        vis_taj = torch.from_numpy(vis_taj).cuda() # 可以类比论文中的memory bank,表示视觉上的历史轨迹
+        self._vis_taj_buf = self._vis_taj_buf.detach()   # drop any graph kept from the last rollout
+        vis_taj = self._vis_taj_buf[:batch_size]
+        vis_taj.zero_() # 可以类比论文中的memory bank,表示视觉上的历史轨迹
 
         for t in range(self.episode_len): #episode_len表示最大探索次数
 
             input_a_t, candidate_feat, candidate_leng = self.get_input_feat(perm_obs,t,vis_taj) #input_a_t表示输入的action，candidate_feat 可以理解为未经过MLP的m_t包含了
-            candidate_feat_for_traj = candidate_feat.clone()
 
-            visual_temp_mask = (utils.length2mask(candidate_leng) == 0).long() #对视觉图像进行mask处理
+            candidate_leng_cu = torch.tensor(candidate_leng, device='cuda').unsqueeze(1)
+            visual_temp_mask = (self._arange(max(candidate_leng)).unsqueeze(0) < candidate_leng_cu).long() #对视觉图像进行mask处理
             visual_attention_mask = torch.cat((language_attention_mask, visual_temp_mask), dim=-1)#对视觉图像的attention进行mask处理
                 
             ''' Visual BERT '''
@@ -338,15 +466,12 @@ class Seq2SeqAgent(BaseAgent):
                             't':                  t,
                             'seq_lengths':        seq_lengths,
                             'att_drop_rate':      att_drop_rate}
-            h_t, visn_output, logit, dis_loss_c = self.vln_bert(**visual_inputs)
+            if lang_kv is not None:
+                visual_inputs['kv_cache'] = lang_kv
+            candidate_mask = self._arange(max(candidate_leng) - t).unsqueeze(0) >= (candidate_leng_cu - t)
+            h_t, visn_output, logit, dis_loss_c = self._step(visual_inputs, candidate_mask)
             hidden_states.append(h_t)
 
-            # Mask outputs where agent can't move forward
-            # Here the logit is [b, max_candidate]
-
-            candidate_mask = utils.length2mask([i-t for i in candidate_leng])
-            logit.masked_fill_(candidate_mask, -float('inf'))
-
             # Supervised training
             target = self._teacher_action(perm_obs, ended)
             ml_loss += self.criterion(logit, target)
@@ -360,73 +485,68 @@ class Seq2SeqAgent(BaseAgent):
                 log_probs = F.log_softmax(logit, 1)                              # Calculate the log_prob here
                 policy_log_probs.append(log_probs.gather(1, a_t.unsqueeze(1)))   # Gather the log_prob for each batch
             elif self.feedback == 'sample':
-                probs = F.softmax(logit, 1)  # sampling an action from model
-                c = torch.distributions.Categorical(probs)
-                self.logs['entropy'].append(c.entropy().sum().item())            # For log
-                entropys.append(c.entropy())                                     # For optimization
-                a_t = c.sample().detach()
-                policy_log_probs.append(c.log_prob(a_t))
+                log_probs = F.log_softmax(logit, 1)  # sampling an action from model
+                probs = log_probs.exp()
+                # the clamp keeps 0 * -inf from the masked candidates out of the entropy
+                p_log_p = probs * log_probs.clamp(min=torch.finfo(log_probs.dtype).min)
+                entropys.append(-p_log_p.sum(1))                                 # For optimization
+                self.logs['entropy'].append(entropys[-1].sum().item())           # For log
+                a_t = torch.multinomial(probs, 1).squeeze(1).detach()
+                policy_log_probs.append(log_probs.gather(1, a_t.unsqueeze(1)).squeeze(1))
             else:
                 print(self.feedback)
                 sys.exit('Invalid feedback option')
             # Prepare environment action
             # NOTE: Env action is in the perm_obs space
             cpu_a_t = a_t.cpu().numpy()
-     
-            for i in range(len(candidate_feat_for_traj)):
-                if cpu_a_t[i] == args.ignoreid:
-                    continue
-                index = cpu_a_t[i]+t
-                if t > 0:
-                    vis_taj[i,:t,:] = candidate_feat_for_traj[i,:t,:]
 
-            for i, next_id in enumerate(cpu_a_t):
-                if next_id == (candidate_leng[i]-1-t) or next_id == args.ignoreid or ended[i]:
-                    cpu_a_t[i] = -1 
-                else:
-                    index = cpu_a_t[i] 
-                    vis_taj[i, t, :self.feature_size] = visn_output[i, index, :]
+            # vis_taj[:, :t] is already resident from earlier steps; the only new
+            # history is the step-t action feature folded into the t-1 slot and
+            # the chosen view feature written at slot t
+            if t > 0:
+                keep = np.nonzero(cpu_a_t != args.ignoreid)[0]
+                if len(keep) > 0:
+                    keep_cu = torch.from_numpy(keep).cuda()
+                    vis_taj[keep_cu, t-1, -args.angle_feat_size:] = input_a_t[keep_cu]
+
+            leng_np = np.asarray(candidate_leng)
+            cpu_a_t[(cpu_a_t == leng_np - 1 - t) | (cpu_a_t == args.ignoreid) | ended] = -1
+            valid = np.nonzero(cpu_a_t != -1)[0]
+            if len(valid) > 0:
+                valid_cu = torch.from_numpy(valid).cuda()
+                index_cu = torch.from_numpy(cpu_a_t[valid]).cuda()
+                vis_taj[valid_cu, t, :self.feature_size] = visn_output[valid_cu, index_cu, :]
 
             # Make action and get the new state
             self.make_equiv_action(cpu_a_t, perm_obs, perm_idx, traj)
-            obs = np.array(self.env._get_obs())
-            perm_obs = obs[perm_idx]            # Perm the obs for the resu
+            self._obs_buf[:batch_size] = self.env._get_obs()
+            np.take(obs, perm_idx_np, out=perm_obs)            # Perm the obs for the resu
 
             if train_rl: # RL的部分，可以不用管，要用的时候直接copy
                 # Calculate the mask and reward
-                dist = np.zeros(batch_size, np.float32)
-                ndtw_score = np.zeros(batch_size, np.float32)
-                reward = np.zeros(batch_size, np.float32)
-                mask = np.ones(batch_size, np.float32)
+                dist = last_dist.copy()
+                ndtw_score = last_ndtw.copy()
                 for i, ob in enumerate(perm_obs):
+                    if ended[i] or cpu_a_t[i] == -1:    # the path did not change, the cached score still holds
+                        continue
                     dist[i] = ob['distance']
                     path_act = [vp[0] for vp in traj[i]['path']]
                     ndtw_score[i] = self.ndtw_criterion[ob['scan']](path_act, ob['gt_path'], metric='ndtw')
 
-                    if ended[i]:
-                        reward[i] = 0.0
-                        mask[i] = 0.0
-                    else:
-                        action_idx = cpu_a_t[i]
-                        # Target reward
-                        if action_idx == -1:                              # If the action now is end
-                            if dist[i] < 3.0:                             # Correct
-                                reward[i] = 2.0 + ndtw_score[i] * 2.0
-                            else:                                         # Incorrect
-                                reward[i] = -2.0
-                        else:                                             # The action is not end
-                            # Path fidelity rewards (distance & nDTW)
-                            reward[i] = - (dist[i] - last_dist[i])
-                            ndtw_reward = ndtw_score[i] - last_ndtw[i]
-                            if reward[i] > 0.0:                           # Quantification
-                                reward[i] = 1.0 + ndtw_reward
-                            elif reward[i] < 0.0:
-                                reward[i] = -1.0 + ndtw_reward
-                            else:
-                                raise NameError("The action doesn't change the move")
-                            # Miss the target penalty
-                            if (last_dist[i] <= 1.0) and (dist[i]-last_dist[i] > 0.0):
-                                reward[i] -= (1.0 - last_dist[i]) * 2.0
+                mask = (~ended).astype(np.float32)
+                end_mask = (cpu_a_t == -1)
+                delta = last_dist - dist            # > 0 means the agent moved closer
+                ndtw_reward = ndtw_score - last_ndtw
+                if np.any(~ended & ~end_mask & (delta == 0.0)):
+                    raise NameError("The action doesn't change the move")
+                # Target reward at the end, path fidelity (distance & nDTW quantification) otherwise
+                reward = np.where(end_mask,
+                                  np.where(dist < 3.0, 2.0 + ndtw_score * 2.0, -2.0),
+                                  np.sign(delta) + ndtw_reward)
+                # Miss the target penalty
+                reward = np.where(~end_mask & (last_dist <= 1.0) & (delta < 0.0),
+                                  reward - (1.0 - last_dist) * 2.0, reward)
+                reward = (reward * mask).astype(np.float32)
                 rewards.append(reward)
                 masks.append(mask)
                 last_dist[:] = dist
@@ -444,7 +564,8 @@ class Seq2SeqAgent(BaseAgent):
             # Last action in A2C
             input_a_t, candidate_feat, candidate_leng = self.get_input_feat(perm_obs, t+1, vis_taj)
 
-            visual_temp_mask = (utils.length2mask(candidate_leng) == 0).long()
+            candidate_leng_cu = torch.tensor(candidate_leng, device='cuda').unsqueeze(1)
+            visual_temp_mask = (self._arange(max(candidate_leng)).unsqueeze(0) < candidate_leng_cu).long()
             visual_attention_mask = torch.cat((language_attention_mask, visual_temp_mask), dim=-1)
 
             ''' Visual BERT '''
@@ -460,26 +581,37 @@ class Seq2SeqAgent(BaseAgent):
                             't':                  t+1,
                             'seq_lengths':        seq_lengths,
                             'att_drop_rate':      att_drop_rate}
+            if lang_kv is not None:
+                visual_inputs['kv_cache'] = lang_kv
             last_h_, _, _, _ = self.vln_bert(**visual_inputs)
 
             rl_loss = 0.
 
             # NOW, A2C!!!
             # Calculate the final discounted reward
-            last_value__ = self.critic(last_h_).detach()        # The value esti of the last state, remove the grad for safety
-            discount_reward = np.zeros(batch_size, np.float32)  # The inital reward is zero
-            for i in range(batch_size):
-                if not ended[i]:        # If the action is not ended, use the value function as the last reward
-                    discount_reward[i] = last_value__[i]
+            with torch.cuda.amp.autocast(enabled=False):    # the critic and value targets stay in fp32
+                last_value__ = self.critic(last_h_.float()).detach()        # The value esti of the last state, remove the grad for safety
+            # One H2D transfer for all masks and rewards instead of two tiny
+            # copies per step of the backward scan
+            masks_cu = torch.from_numpy(np.stack(masks)).cuda(non_blocking=True)        # (T, B)
+            rewards_cu = torch.from_numpy(np.stack(rewards)).cuda(non_blocking=True)    # (T, B)
+            discount_reward = torch.zeros(batch_size, device='cuda')  # The inital reward is zero
+            not_ended = torch.from_numpy(~ended).cuda()
+            # If the action is not ended, use the value function as the last reward
+            discount_reward[not_ended] = last_value__[not_ended]
 
             length = len(rewards)
+            # One batched critic forward over all steps instead of T small GEMMs
+            with torch.cuda.amp.autocast(enabled=False):
+                hidden_states_ = torch.stack(hidden_states, 0)                  # (T, B, H)
+                values = self.critic(hidden_states_.view(-1, hidden_states_.size(-1)).float()) \
+                             .view(length, batch_size)
             total = 0
             for t in range(length-1, -1, -1):
-                discount_reward = discount_reward * args.gamma + rewards[t]  # If it ended, the reward will be 0
-                mask_ = Variable(torch.from_numpy(masks[t]), requires_grad=False).cuda()
-                clip_reward = discount_reward.copy()
-                r_ = Variable(torch.from_numpy(clip_reward), requires_grad=False).cuda()
-                v_ = self.critic(hidden_states[t])
+                discount_reward = discount_reward * args.gamma + rewards_cu[t]  # If it ended, the reward will be 0
+                mask_ = masks_cu[t]
+                r_ = discount_reward
+                v_ = values[t]
                 a_ = (r_ - v_).detach()
 
                 rl_loss += (-policy_log_probs[t] * a_ * mask_).sum()
@@ -540,7 +672,8 @@ class Seq2SeqAgent(BaseAgent):
     def optim_step(self):
         self.loss.backward()
 
-        torch.nn.utils.clip_grad_norm(self.vln_bert.parameters(), 40.)
+        torch.nn.utils.clip_grad_norm_(self.vln_bert.parameters(), 40., **_CLIP_KWARGS)
+        torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 40., **_CLIP_KWARGS)
 
         self.vln_bert_optimizer.step()
         self.critic_optimizer.step()
@@ -553,16 +686,26 @@ class Seq2SeqAgent(BaseAgent):
         self.vln_bert.train()
         self.critic.train()
 
+        # Pair the local/shared tensors once; copying in place avoids the full
+        # state_dict materialization (two model-size allocations) per iteration
+        if getattr(self, '_shared_src', None) is not shared_models:
+            self._shared_src = shared_models
+            self._param_pairs = []
+            for model, shared_model in zip(self.models, shared_models):
+                self._param_pairs.extend(zip(model.parameters(), shared_model.parameters()))
+                self._param_pairs.extend(zip(model.buffers(), shared_model.buffers()))
+
         self.losses = []
         for iter in range(1, n_iters + 1):
-            for model, shared_model in zip(self.models, shared_models):
-                model.load_state_dict(shared_model.state_dict())
+            with torch.no_grad():
+                for p, shared_p in self._param_pairs:
+                    p.copy_(shared_p, non_blocking=True)
 
             self.vln_bert.zero_grad()
             self.critic.zero_grad()
 
             self.loss = 0
-            with torch.cuda.amp.autocast():
+            with torch.cuda.amp.autocast(dtype=self._amp_dtype):
                 if feedback == 'teacher':
                     self.feedback = 'teacher'
                     self.rollout(train_ml=args.teacher_weight, train_dis_l=args.distance_weight, train_dis_c=args.distance_weight_c, att_drop_rate=args.drop_rate, train_rl=False, **kwargs)